@@ -1,3 +1,4 @@
+import functools
 import os
 
 class Config:
@@ -20,17 +21,21 @@ class Config:
     # Get this from your Viber Public Account settings.
     VIBER_BOT_TOKEN = os.getenv("VIBER_BOT_TOKEN", "YOUR_VIBER_BOT_TOKEN_HERE")
 
-    # Viber Bot App Key for signature verification (if fully implemented for security)
-    # This is currently not used for verification in main.py, but kept for future implementation.
-    # IMPORTANT: In a real app, this MUST be a strong, randomly generated key and used for signature verification.
+    # Viber Bot App Key (unused). Webhook signatures (X-Viber-Content-Signature) are verified
+    # with VIBER_BOT_TOKEN, which is the key Viber signs callbacks with.
     VIBER_BOT_APP_KEY = os.getenv("VIBER_BOT_APP_KEY", "your_viber_app_key_placeholder") # Replace or get from env
 
+    # Optional: Redis URL for conversation state (e.g. redis://localhost:6379/0).
+    # When unset, state is kept in process memory and is lost on restart.
+    REDIS_URL = os.getenv("REDIS_URL", "")
+
     # Optional: Customer Agent Contact Info (if used for direct contact outside bot flow)
     CUSTOMER_AGENT_VIBER_ID = os.getenv("CUSTOMER_AGENT_VIBER_ID", "+95912345000")
     CUSTOMER_AGENT_PHONE_NUMBER = os.getenv("CUSTOMER_AGENT_PHONE_NUMBER", "+95912345000")
 
-    # Basic check for essential keys on startup
+    # Basic check for essential keys on startup; cached, so repeated calls don't re-check or re-print
     @classmethod
+    @functools.cache
     def validate_keys(cls):
         missing_keys = []
         if not cls.CUSTOMER_API_KEY or cls.CUSTOMER_API_KEY == "sandbox_customer_123_default":
@@ -54,5 +59,6 @@ class Config:
             print("Please ensure these are configured in your deployment environment.")
             print("="*80)
 
-# Validate keys on import (when the app starts)
-Config.validate_keys()
+# Validate keys on import (when the app starts); set VALIDATE_CONFIG=0 to skip
+if os.getenv("VALIDATE_CONFIG", "1") != "0":
+    Config.validate_keys()
@@ -0,0 +1,56 @@
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Shared HTTP client, created once in the app lifespan and reused for every call
+# so outbound requests benefit from keep-alive connections (and HTTP/2 for Viber).
+VIBER_API_BASE_URL = "https://chatapi.viber.com"
+VIBER_SEND_MESSAGE_PATH = "/pa/send_message"
+
+# Per-phase timeouts (seconds): fail fast on connect, allow Viber longer to answer,
+# and don't queue forever when every pooled connection is busy
+HTTP_TIMEOUT = httpx.Timeout(connect=5.0, read=15.0, write=10.0, pool=10.0)
+
+# Connection pool limits sized for bursty webhook traffic
+HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=40, keepalive_expiry=30.0)
+
+_client: httpx.AsyncClient = None
+
+async def _trace_response(response: httpx.Response):
+    # Shows whether calls really share one HTTP/2 connection (http_version) instead of reconnecting
+    logger.debug("%s %s -> %s over %s", response.request.method, response.request.url.path,
+                 response.status_code, response.http_version)
+
+def open_http_client(headers: dict) -> httpx.AsyncClient:
+    global _client
+    # Tracing hooks are only attached when DEBUG logging is on, so production calls carry no hook
+    event_hooks = {"response": [_trace_response]} if logger.isEnabledFor(logging.DEBUG) else None
+    _client = httpx.AsyncClient(
+        base_url=VIBER_API_BASE_URL,
+        http2=True,
+        timeout=HTTP_TIMEOUT,
+        limits=HTTP_LIMITS,
+        headers=headers,
+        event_hooks=event_hooks
+    )
+    return _client
+
+def get_http_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("Shared HTTP client is not open; it is created in the app lifespan")
+    return _client
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def warm_connections():
+    # Best effort: open a pooled connection so the first webhook doesn't pay the handshake
+    try:
+        await get_http_client().head("/")
+    except httpx.HTTPError as e:
+        logger.warning("Connection warm-up to %s failed: %s", VIBER_API_BASE_URL, e)
@@ -1,6 +1,100 @@
-log_store = []
+import asyncio
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
 
-def add_log(entry: dict):
-    log_store.insert(0, entry)  # latest first
-    if len(log_store) > 100:
-        log_store.pop()
+MAX_LOGS = 100
+LOG_FLUSH_BATCH = 256
+
+# Latest first; maxlen evicts the oldest entries from the right in O(1)
+log_store: deque = deque(maxlen=MAX_LOGS)
+
+# Entries are queued on the request path and moved into log_store in batches by log_flusher()
+_log_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+
+@dataclass(slots=True)
+class LogEntry:
+    # Slotted record instead of a per-entry dict; time is kept as raw time.time_ns() and
+    # only formatted when someone reads the logs
+    t_ns: int
+    endpoint: str
+    status: str
+    payload: dict
+    error: str = None
+    id: int = 0
+
+# Monotonic entry ids, so SSE readers can resume after the last entry they saw (Last-Event-ID)
+_log_ids = itertools.count(1)
+
+# Set after each flushed batch and then replaced, so every waiting reader wakes exactly once per batch
+_log_appended = asyncio.Event()
+
+def add_log(entry: LogEntry):
+    entry.id = next(_log_ids)
+    try:
+        _log_queue.put_nowait(entry)
+    except asyncio.QueueFull:
+        # Never block the request path; drop the oldest pending entry, since the monitor shows the latest
+        _log_queue.get_nowait()
+        _log_queue.put_nowait(entry)
+
+async def log_flusher():
+    global _log_appended
+    while True:
+        batch = [await _log_queue.get()]
+        while len(batch) < LOG_FLUSH_BATCH and not _log_queue.empty():
+            batch.append(_log_queue.get_nowait())
+        log_store.extendleft(batch)  # extendleft reverses, so the latest ends up first
+        _log_appended.set()
+        _log_appended = asyncio.Event()
+
+def log_appended() -> asyncio.Event:
+    # Take the event before checking logs_after(); it is set when the next batch lands
+    return _log_appended
+
+def last_log_id() -> int:
+    return log_store[0].id if log_store else 0
+
+def logs_after(last_id: int) -> list:
+    # Stored entries newer than last_id, oldest first; only the new head of the store is walked
+    newer = list(itertools.takewhile(lambda entry: entry.id > last_id, log_store))
+    newer.reverse()
+    return newer
+
+# Second-resolution "now" for places that don't need sub-second precision; formatted at most once per second
+_now_iso_cache = [0, ""]
+
+def now_iso() -> str:
+    sec = time.time_ns() // 1_000_000_000
+    if sec != _now_iso_cache[0]:
+        _now_iso_cache[0] = sec
+        _now_iso_cache[1] = datetime.fromtimestamp(sec, tz=timezone.utc).isoformat()
+    return _now_iso_cache[1]
+
+# Rows formatted together mostly share a second, so only the microseconds are formatted per call
+_format_ns_cache = [-1, ""]
+
+def format_ns(t_ns: int) -> str:
+    sec, rem = divmod(t_ns, 1_000_000_000)
+    if sec != _format_ns_cache[0]:
+        _format_ns_cache[0] = sec
+        _format_ns_cache[1] = datetime.fromtimestamp(sec, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    return f"{_format_ns_cache[1]}.{rem // 1000:06d}+00:00"
+
+# Readers (monitor page, JSON dump, SSE) get plain dicts with the formatted time
+def format_log(entry: LogEntry) -> dict:
+    formatted = {
+        "id": entry.id,
+        "time": format_ns(entry.t_ns),
+        "endpoint": entry.endpoint,
+        "status": entry.status,
+        "payload": entry.payload
+    }
+    if entry.error:
+        formatted["error"] = entry.error
+    return formatted
+
+def get_logs() -> list:
+    return [format_log(entry) for entry in log_store]
@@ -1,50 +1,190 @@
 from fastapi import FastAPI, Request, Header, HTTPException, status, Depends
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, ORJSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pydantic import BaseModel, ValidationError
-from datetime import datetime
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
 import uvicorn
 import os
 import secrets
+import hmac
+import hashlib
 import httpx
 import asyncio
-import json
+import time
+import weakref
+import orjson
+import functools
+import logging
+import logging.handlers
+import queue
+import re
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from collections import deque
+from cachetools import TTLCache
 
 # Import configuration and logging
 from config import Config
-from log_storage import add_log, log_store
-
-app = FastAPI()
+from log_storage import LogEntry, add_log, log_flusher, log_appended, last_log_id, logs_after, format_log, format_ns, get_logs, now_iso
+from http_client import VIBER_SEND_MESSAGE_PATH, open_http_client, get_http_client, close_http_client, warm_connections
+from state_storage import get_state, set_state, clear_state, touch_state, state_sweeper, close_state_storage
+
+# Records are handed to a listener thread, so writing them to stderr never blocks the event loop
+_log_records = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_records, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_records)]
+)
+
+class _RateLimitFilter(logging.Filter):
+    # Lets each warning/error message template through at most once per interval, so an outage
+    # (e.g. Viber unreachable) logs one line per interval instead of one per failed reply
+    def __init__(self, interval: float = 10.0):
+        super().__init__()
+        self.interval = interval
+        self._last_emitted = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.msg, record.levelno)
+        if record.created - self._last_emitted.get(key, 0.0) < self.interval:
+            return False
+        self._last_emitted[key] = record.created
+        return True
+
+logger = logging.getLogger(__name__)
+logger.addFilter(_RateLimitFilter())
+
+# httpx/httpcore log every request at INFO; with a root handler configured that would add a line
+# per Viber send, so only their warnings and errors get through
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
+def _web_concurrency() -> int:
+    # Unset, empty or non-numeric values mean the default single worker rather than a startup error
+    try:
+        return int(os.getenv("WEB_CONCURRENCY") or "1")
+    except ValueError:
+        return 1
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Logs, agent subscribers, per-sender locks and webhook dedup are per process, so extra
+    # workers would each see only part of the traffic. Only WEB_CONCURRENCY (which uvicorn and
+    # gunicorn read as their default worker count) is checked; --workers/-w on the command line is not
+    if _web_concurrency() > 1:
+        logger.warning("WEB_CONCURRENCY > 1: run a single worker; monitor logs, agent events and webhook "
+                       "ordering are per process (only WEB_CONCURRENCY is checked, not --workers/-w)")
+    # Viber headers are sent on every call, so set once on the shared client rather than per request
+    app.state.viber_client = open_http_client(
+        headers={"X-Viber-Auth-Token": CFG.viber_token, "Content-Type": "application/json"}
+    )
+    # Warm up in the background so startup isn't blocked on the network
+    warm_up_task = asyncio.create_task(warm_connections())
+    log_flusher_task = asyncio.create_task(log_flusher())
+    state_sweeper_task = asyncio.create_task(state_sweeper())
+    _log_listener.start()
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        # Let webhook events already acknowledged to Viber finish before the client goes away
+        if _webhook_tasks:
+            await asyncio.wait(_webhook_tasks, timeout=WEBHOOK_DRAIN_SECONDS)
+        log_flusher_task.cancel()
+        state_sweeper_task.cancel()
+        await close_http_client()
+        await close_state_storage()
+        _log_listener.stop()
+
+class GZipExceptStreams(GZipMiddleware):
+    # Starlette's gzip buffers streamed bodies until its chunk fills, which would
+    # stall SSE heartbeats and events, so the /events streams bypass compression
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/events"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# Compress the monitor/dashboard HTML and log dumps (Myanmar text compresses well)
+app.add_middleware(GZipExceptStreams, minimum_size=500, compresslevel=6)
 templates = Jinja2Templates(directory="templates")
 
-# Initialize HTTPBasic for security
-security = HTTPBasic()
+def _orjson_tojson(obj, indent: int = None) -> str:
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+    return orjson.dumps(obj, option=option).decode()
 
-# Use values from Config class
-# API Keys for internal UAT endpoints
-API_KEYS = {
-    "CUSTOMER_API_KEY": Config.CUSTOMER_API_KEY,
-    "BILLING_API_KEY": Config.BILLING_API_KEY,
-    "CHATLOG_API_KEY": Config.CHATLOG_API_KEY
-}
+# The monitor's `tojson` filter encodes every log payload; use orjson for it like the API responses
+# do (Jinja still HTML-escapes the result). Its default sort_keys kwarg is not an orjson argument.
+templates.env.policies["json.dumps_function"] = _orjson_tojson
+templates.env.policies["json.dumps_kwargs"] = {}
 
-# Monitor UI credentials
-MONITOR_USERNAME = Config.MONITOR_USERNAME
-MONITOR_PASSWORD = Config.MONITOR_PASSWORD
+# Cheap integer timestamps for hot paths; formatted to ISO only when displayed
+_now = time.time_ns
 
-# Viber Bot Token
-VIBER_BOT_TOKEN = Config.VIBER_BOT_TOKEN
+# Initialize HTTPBasic for security
+security = HTTPBasic()
+
+# Use values from Config class, read once into an immutable settings object
+@dataclass(frozen=True, slots=True)
+class Settings:
+    # Expected Authorization header values for the internal UAT endpoints
+    customer_token: bytes
+    billing_token: bytes
+    chatlog_token: bytes
+    # Monitor UI credentials
+    monitor_user: bytes
+    monitor_pass: bytes
+    # Viber Bot Token, and its bytes as the key Viber signs webhook bodies with
+    viber_token: str
+    viber_signing_key: bytes
+
+CFG = Settings(
+    customer_token=f"Bearer {Config.CUSTOMER_API_KEY}".encode(),
+    billing_token=f"Bearer {Config.BILLING_API_KEY}".encode(),
+    chatlog_token=f"Bearer {Config.CHATLOG_API_KEY}".encode(),
+    monitor_user=Config.MONITOR_USERNAME.encode(),
+    monitor_pass=Config.MONITOR_PASSWORD.encode(),
+    viber_token=Config.VIBER_BOT_TOKEN,
+    viber_signing_key=Config.VIBER_BOT_TOKEN.encode()
+)
+
+# Decided once: without a real bot token every send is skipped (config.py already warns at startup)
+VIBER_SEND_ENABLED = bool(CFG.viber_token) and CFG.viber_token != "YOUR_VIBER_BOT_TOKEN_HERE"
 
 # Customer Agent Contact Info (if needed, otherwise can be removed)
 # CUSTOMER_AGENT_VIBER_ID = Config.CUSTOMER_AGENT_VIBER_ID
 # CUSTOMER_AGENT_PHONE_NUMBER = Config.CUSTOMER_AGENT_PHONE_NUMBER
 
-# In-memory store for user conversation states (for multi-step flows)
-user_states = {} # Structure: {viber_user_id: {"state": "CURRENT_STATE", "data": {...}}}
+# One buffer per connected agent dashboard (SSE), so every dashboard receives every event.
+# Each buffer is bounded; a slow dashboard loses its oldest frames first.
+AGENT_SUBSCRIBER_BUFFER_SIZE = 1024
+
+@dataclass(slots=True, eq=False)
+class AgentSubscriber:
+    frames: deque = field(default_factory=lambda: deque(maxlen=AGENT_SUBSCRIBER_BUFFER_SIZE))
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
 
-# In-memory queue for broadcasting messages/events to agent dashboards (SSE)
-agent_broadcast_queue: asyncio.Queue = asyncio.Queue()
+agent_subscribers: set[AgentSubscriber] = set()
+_broadcast_drops = 0
+
+def publish_agent_event(event: dict):
+    global _broadcast_drops
+    if not agent_subscribers:
+        return
+    # Serialize once and hand the same frame to every subscriber
+    frame = sse_frame(event)
+    for subscriber in agent_subscribers:
+        if len(subscriber.frames) == AGENT_SUBSCRIBER_BUFFER_SIZE:
+            _broadcast_drops += 1
+        subscriber.frames.append(frame)  # maxlen evicts the oldest frame
+        subscriber.ready.set()
 
 # Define conversation states
 STATE_IDLE = "IDLE"
@@ -66,79 +206,76 @@ STATE_COLLECTING_CHATLOG_MESSAGE = "COLLECTING_CHATLOG_MESSAGE"
 
 # Agent conversation states
 STATE_TALKING_TO_AGENT = "TALKING_TO_AGENT"
+STOP_AGENT_CHAT_TEXT = "ရပ်မည်" # Typed by the user to leave the agent conversation
+
+# Request bodies are read-only once validated; unknown fields are rejected instead of carried along
+class FrozenModel(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
 
-class CustomerCreate(BaseModel):
+class CustomerCreate(FrozenModel):
     name: str
     phone: str
     region: str
 
-class Payment(BaseModel):
+class Payment(FrozenModel):
     user_id: str
     amount: int
     method: str
     reference_id: str
 
-class ChatLog(BaseModel):
+class ChatLog(FrozenModel):
     viber_id: str
     message: str
     timestamp: str
     type: str
 
 # Pydantic models for Agent Dashboard communication
-class AgentSendMessage(BaseModel):
+class AgentSendMessage(FrozenModel):
     receiver_viber_id: str
     message_text: str
 
-class AgentEndChat(BaseModel):  # Fixed typo: Baseodel -> BaseModel
+class AgentEndChat(FrozenModel):
     viber_id: str
 
-def check_auth(token: str, expected_key_name: str):
-    expected_token = f"Bearer {API_KEYS.get(expected_key_name)}"  # Fixed: removed extra )
-    if token != expected_token:
+def check_auth(token: str, expected_token: bytes, expected_key_name: str):
+    # Constant-time comparison against the precomputed header value
+    if not hmac.compare_digest(token.encode(), expected_token):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Unauthorized: Invalid token for {expected_key_name}"
         )
 
 def log_request(endpoint: str, status_icon: str, payload: dict, error_detail: str = None):
-    log_entry = {
-        "time": datetime.utcnow().isoformat(),
-        "endpoint": endpoint,
-        "status": status_icon,
-        "payload": payload
-    }
-    if error_detail:
-        log_entry["error"] = error_detail
-    add_log(log_entry)
+    add_log(LogEntry(_now(), endpoint, status_icon, payload, error_detail))
+
+# Encoded JSON for reply texts. Most replies are fixed Burmese strings (~3 UTF-8 bytes per
+# character), so repeats reuse the encoded bytes instead of encoding them again
+_encode_text = functools.lru_cache(maxsize=256)(orjson.dumps)
 
 # Helper function to send messages back to Viber
 async def send_viber_message(receiver_id: str, text: str, keyboard: dict = None):
-    if not VIBER_BOT_TOKEN or VIBER_BOT_TOKEN == "YOUR_VIBER_BOT_TOKEN_HERE":
-        print("Viber bot token not set. Cannot send message.")
+    if not VIBER_SEND_ENABLED:
+        logger.warning("Viber bot token not set. Cannot send message.")
         return
 
-    viber_api_url = "https://chatapi.viber.com/pa/send_message"
-    headers = {
-        "X-Viber-Auth-Token": VIBER_BOT_TOKEN,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "receiver": receiver_id,
-        "type": "text",
-        "text": text
-    }
-    if keyboard:
-        payload["keyboard"] = keyboard
+    if keyboard is MAIN_MENU_KEYBOARD:
+        # Splice in the pre-encoded main menu instead of re-serializing it on every send
+        tail = MAIN_MENU_KEYBOARD_SUFFIX
+    elif keyboard:
+        tail = b',"keyboard":' + orjson.dumps(keyboard) + b"}"
+    else:
+        tail = b"}"
+    body = b"".join((b'{"receiver":', orjson.dumps(receiver_id), b',"type":"text","text":', _encode_text(text), tail))
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(viber_api_url, headers=headers, json=payload)
-            response.raise_for_status()
-            print(f"Viber message sent to {receiver_id}: {response.json()}")
-        except httpx.HTTPStatusError as e:
-            print(f"Error sending Viber message to {receiver_id}: {e.response.status_code} - {e.response.text}")
-        except httpx.RequestError as e:
-            print(f"Network error sending Viber message to {receiver_id}: {e}")
+    try:
+        response = await get_http_client().post(VIBER_SEND_MESSAGE_PATH, content=body)
+        response.raise_for_status()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Viber message sent to %s: %s", receiver_id, response.text)
+    except httpx.HTTPStatusError as e:
+        logger.error("Error sending Viber message to %s: %s - %s", receiver_id, e.response.status_code, e.response.text)
+    except httpx.RequestError as e:
+        logger.error("Network error sending Viber message to %s: %s", receiver_id, e)
 
 # Main Menu Keyboard with all options (Myanmarized)
 MAIN_MENU_KEYBOARD = {
@@ -194,92 +331,49 @@ MAIN_MENU_KEYBOARD = {
     ]
 }
 
-# Helper to get the base URL for internal API calls (important for Render deployment)
-def get_internal_base_url():
-    # Use RENDER_EXTERNAL_URL environment variable from Render as defined in Config
-    return Config.BASE_URL
-
-# Refactored core logic functions to make internal API calls
-async def _process_customer_creation(data: CustomerCreate):
-    internal_auth_token = f"Bearer {API_KEYS['CUSTOMER_API_KEY']}"
-    async with httpx.AsyncClient() as client:
-        try:
-            base_url = get_internal_base_url()
-            response = await client.post(
-                f"{base_url}/uat/customers/create",
-                headers={"Authorization": internal_auth_token, "Content-Type": "application/json"},
-                json=data.dict()
-            )
-            response.raise_for_status()
-            log_request("/internal/customer_create_logic", "💾 Processed", data.dict())
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            log_request("/internal/customer_create_logic", "💥 API Error", data.dict(), f"HTTP Error: {e.response.status_code} - {e.response.text}")
-            return {"status": "error", "message": f"API Error: {e.response.text}"}
-        except Exception as e:
-            log_request("/internal/customer_create_logic", "💥 Processing Error", data.dict(), str(e))
-            return {"status": "error", "message": f"Internal Processing Error: {str(e)}"}
-
-async def _process_payment_record(data: Payment):
-    internal_auth_token = f"Bearer {API_KEYS['BILLING_API_KEY']}"
-    async with httpx.AsyncClient() as client:
-        try:
-            base_url = get_internal_base_url()
-            response = await client.post(
-                f"{base_url}/uat/payments",
-                headers={"Authorization": internal_auth_token, "Content-Type": "application/json"},
-                json=data.dict()
-            )
-            response.raise_for_status()
-            log_request("/internal/payment_record_logic", "💾 Processed", data.dict())
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            log_request("/internal/payment_record_logic", "💥 API Error", data.dict(), f"HTTP Error: {e.response.status_code} - {e.response.text}")
-            return {"status": "error", "message": f"API Error: {e.response.text}"}
-        except Exception as e:
-            log_request("/internal/payment_record_logic", "💥 Processing Error", data.dict(), str(e))
-            return {"status": "error", "message": f"Internal Processing Error: {str(e)}"}
-
-async def _process_chat_log_submission(data: ChatLog):
-    internal_auth_token = f"Bearer {API_KEYS['CHATLOG_API_KEY']}"
-    async with httpx.AsyncClient() as client:
-        try:
-            base_url = get_internal_base_url()
-            response = await client.post(
-                f"{base_url}/uat/chat-logs",
-                headers={"Authorization": internal_auth_token, "Content-Type": "application/json"},
-                json=data.dict()
-            )
-            response.raise_for_status()
-            log_request("/internal/chat_log_logic", "💾 Processed", data.dict())
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            log_request("/internal/chat_log_logic", "💥 API Error", data.dict(), f"HTTP Error: {e.response.status_code} - {e.response.text}")
-            return {"status": "error", "message": f"API Error: {e.response.text}"}
-        except Exception as e:
-            log_request("/internal/chat_log_logic", "💥 Processing Error", data.dict(), str(e))
-            return {"status": "error", "message": f"Internal Processing Error: {str(e)}"}
-
-async def _trigger_simulate_failure():
-    internal_auth_token = f"Bearer {API_KEYS['CUSTOMER_API_KEY']}"
-    async with httpx.AsyncClient() as client:
-        try:
-            base_url = get_internal_base_url()
-            response = await client.post(
-                f"{base_url}/uat/simulate-failure",
-                headers={"Authorization": internal_auth_token, "Content-Type": "application/json"},
-                json={}
-            )
-            response.raise_for_status()
-            log_request("/internal/simulate_failure_logic", "💾 Triggered", {})
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            log_request("/internal/simulate_failure_logic", "💥 API Error", {}, f"HTTP Error: {e.response.status_code} - {e.response.text}")
-            return {"status": "error", "message": f"API Error: {e.response.text}"}
-        except Exception as e:
-            log_request("/internal/simulate_failure_logic", "💥 Processing Error", {}, str(e))
-            return {"status": "error", "message": f"Internal Processing Error: {str(e)}"}
+# The main menu never changes, so encode it once at import time
+MAIN_MENU_KEYBOARD_JSON = orjson.dumps(MAIN_MENU_KEYBOARD)
+# Tail of a send_message body carrying the main menu, replacing the payload's closing brace
+MAIN_MENU_KEYBOARD_SUFFIX = b',"keyboard":' + MAIN_MENU_KEYBOARD_JSON + b"}"
+
+# Core UAT endpoint logic, shared by the HTTP routes and the in-process bot flows
+async def _do_create_customer(payload: dict):
+    log_request("/uat/customers/create", "✅ Success", payload)
+    return {"status": "success", "message": "Customer created successfully (UAT)"}
+
+async def _do_record_payment(payload: dict):
+    log_request("/uat/payments", "✅ Success", payload)
+    return {"status": "success", "message": "Payment recorded (UAT)"}
+
+async def _do_submit_chat(payload: dict):
+    log_request("/uat/chat-logs", "✅ Success", payload)
+    return {"status": "success", "message": "Chat log saved (UAT)"}
+
+async def _do_simulate_failure(payload: dict):
+    # Intentionally raise an error to simulate an internal failure
+    raise ValueError("Simulated internal processing error for UAT testing!")
+
+# Operations the bot flows run in-process: name -> (UAT logic, log endpoint, success status)
+_INTERNAL_OPERATIONS = {
+    "customer": (_do_create_customer, "/internal/customer_create_logic", "💾 Processed"),
+    "payment": (_do_record_payment, "/internal/payment_record_logic", "💾 Processed"),
+    "chatlog": (_do_submit_chat, "/internal/chat_log_logic", "💾 Processed"),
+    "simfail": (_do_simulate_failure, "/internal/simulate_failure_logic", "💾 Triggered"),
+}
 
+# Refactored core logic, called in-process instead of looping back over HTTP.
+# These calls never leave the process, so they skip check_auth and request-model validation:
+# the bot flows are trusted callers and validate each field as it is collected.
+async def _run_internal(operation: str, payload: dict = None):
+    handler, log_endpoint, success_status = _INTERNAL_OPERATIONS[operation]
+    payload = payload if payload is not None else {}
+    try:
+        result = await handler(payload)
+        log_request(log_endpoint, success_status, payload)
+        return result
+    except Exception as e:
+        log_request(log_endpoint, "💥 Processing Error", payload, str(e))
+        return {"status": "error", "message": f"Internal Processing Error: {str(e)}"}
 
 @app.get("/")
 async def read_root():
@@ -287,7 +381,7 @@ async def read_root():
 
 @app.get("/health")  # Added health check endpoint
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return {"status": "healthy", "timestamp": now_iso()}
 
 @app.get("/favicon.ico", include_in_schema=False)
 async def get_favicon():
@@ -297,52 +391,51 @@ async def get_favicon():
 @app.post("/uat/customers/create")
 async def create_customer(data: CustomerCreate, authorization: str = Header(...)):
     endpoint = "/uat/customers/create"
+    payload = data.model_dump()
     try:
-        check_auth(authorization, "CUSTOMER_API_KEY")
-        log_request(endpoint, "✅ Success", data.dict())
-        return {"status": "success", "message": "Customer created successfully (UAT)"}
+        check_auth(authorization, CFG.customer_token, "CUSTOMER_API_KEY")
+        return await _do_create_customer(payload)
     except HTTPException as e:
-        log_request(endpoint, "❌ Auth Failed", data.dict(), e.detail)
+        log_request(endpoint, "❌ Auth Failed", payload, e.detail)
         raise e
     except Exception as e:
-        log_request(endpoint, "💥 Error", data.dict(), str(e))
+        log_request(endpoint, "💥 Error", payload, str(e))
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
 @app.post("/uat/payments")
 async def record_payment(data: Payment, authorization: str = Header(...)):
     endpoint = "/uat/payments"
+    payload = data.model_dump()
     try:
-        check_auth(authorization, "BILLING_API_KEY")
-        log_request(endpoint, "✅ Success", data.dict())
-        return {"status": "success", "message": "Payment recorded (UAT)"}
+        check_auth(authorization, CFG.billing_token, "BILLING_API_KEY")
+        return await _do_record_payment(payload)
     except HTTPException as e:
-        log_request(endpoint, "❌ Auth Failed", data.dict(), e.detail)
+        log_request(endpoint, "❌ Auth Failed", payload, e.detail)
         raise e
     except Exception as e:
-        log_request(endpoint, "💥 Error", data.dict(), str(e))
+        log_request(endpoint, "💥 Error", payload, str(e))
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
 @app.post("/uat/chat-logs")
 async def submit_chat(data: ChatLog, authorization: str = Header(...)):
     endpoint = "/uat/chat-logs"
+    payload = data.model_dump()
     try:
-        check_auth(authorization, "CHATLOG_API_KEY")
-        log_request(endpoint, "✅ Success", data.dict())
-        return {"status": "success", "message": "Chat log saved (UAT)"}
+        check_auth(authorization, CFG.chatlog_token, "CHATLOG_API_KEY")
+        return await _do_submit_chat(payload)
     except HTTPException as e:
-        log_request(endpoint, "❌ Auth Failed", data.dict(), e.detail)
+        log_request(endpoint, "❌ Auth Failed", payload, e.detail)
         raise e
     except Exception as e:
-        log_request(endpoint, "💥 Error", data.dict(), str(e))
+        log_request(endpoint, "💥 Error", payload, str(e))
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
 @app.post("/uat/simulate-failure")
 async def simulate_failure(authorization: str = Header(...)):
     endpoint = "/uat/simulate-failure"
     try:
-        check_auth(authorization, "CUSTOMER_API_KEY")
-        # Intentionally raise an error to simulate an internal failure
-        raise ValueError("Simulated internal processing error for UAT testing!")
+        check_auth(authorization, CFG.customer_token, "CUSTOMER_API_KEY")
+        return await _do_simulate_failure({})
 
     except HTTPException as e: # Re-raise HTTPExceptions (e.g., from check_auth) directly
         log_request(endpoint, "❌ Auth Failed", {"detail": "Auth attempt"}, e.detail)
@@ -352,26 +445,333 @@ async def simulate_failure(authorization: str = Header(...)):
         log_request(endpoint, "💥 Error", {"detail": "Simulated error triggered"}, error_message)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=error_message)
 
-# Helper for common "What else can I help with?" message
-async def send_main_menu(sender_id: str):
-    await send_viber_message(sender_id, "တခြား ဘာများ ကူညီပေးရဦးမလဲ?", MAIN_MENU_KEYBOARD)
+MAIN_MENU_PROMPT = "တခြား ဘာများ ကူညီပေးရဦးမလဲ?"
+
+# Build one Server-Sent Events frame; orjson already returns UTF-8 bytes, so no extra encode step.
+# Events carry a raw "t_ns" timestamp that is formatted only here, on the way out.
+def sse_frame(event: dict) -> bytes:
+    if "t_ns" in event:
+        event = dict(event)
+        event["timestamp"] = format_ns(event.pop("t_ns"))
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+SSE_HEARTBEAT_FRAME = sse_frame({"type": "heartbeat"})
+SSE_KEEPALIVE_SECONDS = 15.0
+SSE_BATCH_MAX = 32
+# Keep proxies (Render/nginx) from caching or buffering event streams
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+AGENT_CONNECTED_FRAME = sse_frame({"type": "connected", "message": "Agent dashboard connected"})
+MONITOR_CONNECTED_FRAME = sse_frame({"type": "connected", "message": "Monitor connected"})
+
+# Helper for common "What else can I help with?" message. An optional status text is
+# sent in the same Viber call, so the user gets one message with the keyboard instead of two.
+async def send_main_menu(sender_id: str, text: str = None):
+    message = f"{text}\n\n{MAIN_MENU_PROMPT}" if text else MAIN_MENU_PROMPT
+    await send_viber_message(sender_id, message, MAIN_MENU_KEYBOARD)
+
+
+# --- Conversation handlers, dispatched by menu command or by current state ---
+# Each collected field is checked as it arrives, so the completed flows hand their data
+# straight to the UAT logic without building and re-validating a model.
+# Menu button clicks
+async def _start_customer_flow(sender_id: str, message_text: str, user_data: dict):
+    await set_state(sender_id, STATE_COLLECTING_CUSTOMER_NAME)
+    await send_viber_message(sender_id, "ဖောက်သည်အသစ် ဖန်တီးပါမယ်။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **အမည်** (ဥပမာ: ဦးအောင်ကျော်) ကို ထည့်သွင်းပေးပါ:")
+
+async def _start_payment_flow(sender_id: str, message_text: str, user_data: dict):
+    await set_state(sender_id, STATE_COLLECTING_PAYMENT_USER_ID)
+    await send_viber_message(sender_id, "ငွေပေးချေမှု မှတ်တမ်းတင်ပါမယ်။ ကျေးဇူးပြု၍ **အသုံးပြုသူ ID** (ဥပမာ: UAT001) ကို ထည့်သွင်းပေးပါ:")
+
+async def _start_chatlog_flow(sender_id: str, message_text: str, user_data: dict):
+    await set_state(sender_id, STATE_COLLECTING_CHATLOG_VIBER_ID)
+    await send_viber_message(sender_id, "Chat Log တင်သွင်းပါမယ်။ ကျေးဇူးပြု၍ **Viber ID** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
+
+async def _run_simulated_failure(sender_id: str, message_text: str, user_data: dict):
+    # Send the progress note while the simulated failure runs
+    _, result = await asyncio.gather(
+        send_viber_message(sender_id, "ချို့ယွင်းချက်အတုကို စတင်ဖန်တီးနေပါပြီ..."),
+        _run_internal("simfail")
+    )
+    if result and result.get("status") == "success":
+        reply = "✅ ချို့ယွင်းချက်အတုကို အောင်မြင်စွာ ဖန်တီးပြီးပါပြီ။"
+    else:
+        reply = f"💥 ချို့ယွင်းချက်အတု endpoint မှ အမှားအယွင်း ပြန်လည်ဖြေကြားပါသည်။: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}"
+    await clear_state(sender_id)
+    await send_main_menu(sender_id, reply)
+
+async def _start_agent_flow(sender_id: str, message_text: str, user_data: dict):
+    await set_state(sender_id, STATE_TALKING_TO_AGENT)
+    agent_message = (
+        "ယခု Customer Agent နှင့် တိုက်ရိုက်စကားပြောဆိုနိုင်ပါပြီ။\n"
+        "Agent မှ ပြန်ဖြေကြားသည်အထိ ခေတ္တစောင့်ဆိုင်းပေးပါ။\n"
+        "စကားပြောဆိုမှုကို ရပ်နားလိုပါက 'ရပ်မည်' ဟု ရိုက်ထည့်ပေးပါ။"
+    )
+    # Notify the agent dashboard about this new conversation
+    publish_agent_event({
+        "type": "new_conversation",
+        "viber_id": sender_id,
+        "t_ns": _now()
+    })
+    await send_viber_message(sender_id, agent_message)
+
+# Replies for the end of each data-collection flow: operation -> (success, failure prefix, error)
+_FLOW_REPLIES = {
+    "customer": (
+        "✅ ဖောက်သည်ကို အောင်မြင်စွာ ဖန်တီးပြီးပါပြီ။ နောက်ထပ် ဝန်ဆောင်မှုများကို လုပ်ဆောင်နိုင်ပါပြီ။",
+        "❌ ဖောက်သည်ဖန်တီးခြင်း မအောင်မြင်ပါ။",
+        "💥 ဖောက်သည်ဖန်တီးနေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။"
+    ),
+    "payment": (
+        "✅ ငွေပေးချေမှု မှတ်တမ်းကို အောင်မြင်စွာ တင်ပြီးပါပြီ။",
+        "❌ ငွေပေးချေမှု မှတ်တမ်းတင်ခြင်း မအောင်မြင်ပါ။",
+        "💥 ငွေပေးချေမှု မှတ်တမ်းတင်နေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။"
+    ),
+    "chatlog": (
+        "✅ Chat Log ကို အောင်မြင်စွာ တင်သွင်းပြီးပါပြီ။",
+        "❌ Chat Log တင်သွင်းခြင်း မအောင်မြင်ပါ။",
+        "💥 Chat Log တင်သွင်းနေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။"
+    ),
+}
+
+# Shared last step of the customer/payment/chat-log flows: run the UAT operation in-process,
+# report the outcome, and return the user to the main menu
+async def _complete_flow(sender_id: str, operation: str, user_data: dict, progress_text: str):
+    success_reply, failure_prefix, error_reply = _FLOW_REPLIES[operation]
+    try:
+        # Send the progress note while the operation runs; the result reply goes out after both
+        _, result = await asyncio.gather(
+            send_viber_message(sender_id, progress_text),
+            _run_internal(operation, user_data)
+        )
+        if result and result.get("status") == "success":
+            reply = success_reply
+        else:
+            reply = f"{failure_prefix}: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}"
+    except Exception:
+        logger.exception("Error running %s flow", operation)
+        reply = error_reply
+
+    await clear_state(sender_id)
+    await send_main_menu(sender_id, reply)
+
+# Customer Creation Flow
+async def _collect_customer_name(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "အမည်မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **အမည်** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["name"] = message_text
+        await set_state(sender_id, STATE_COLLECTING_CUSTOMER_PHONE, user_data)
+        await send_viber_message(sender_id, f"အမည်ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု ဖောက်သည်၏ **ဖုန်းနံပါတ်** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
+
+# International format: "+" followed by 7-15 digits (E.164 length bound)
+_PHONE_RE = re.compile(r"\+\d{7,15}")
+
+async def _collect_customer_phone(sender_id: str, message_text: str, user_data: dict):
+    message_text = message_text.strip()
+    if not _PHONE_RE.fullmatch(message_text):
+        await send_viber_message(sender_id, "ဖုန်းနံပါတ် မမှန်ကန်ပါ။ ကျေးဇူးပြု၍ မှန်ကန်သော **ဖုန်းနံပါတ်** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["phone"] = message_text
+        await set_state(sender_id, STATE_COLLECTING_CUSTOMER_REGION, user_data)
+        await send_viber_message(sender_id, f"ဖုန်းနံပါတ်ကတော့ `{message_text}` ဖြစ်ပါတယ်။ နောက်ဆုံးအနေနဲ့ ဖောက်သည်၏ **တိုင်းဒေသကြီး/ပြည်နယ်** (ဥပမာ: ရန်ကုန်၊ မန္တလေး) ကို ထည့်သွင်းပေးပါ:")
+
+async def _collect_customer_region(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "တိုင်းဒေသကြီး/ပြည်နယ် မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **တိုင်းဒေသကြီး/ပြည်နယ်** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["region"] = message_text
+        await _complete_flow(sender_id, "customer", user_data, "ကျေးဇူးတင်ပါတယ်။ ဖောက်သည်အချက်အလက်များကို ဆောင်ရွက်နေပါပြီ...")
+
+# Payment Recording Flow
+async def _collect_payment_user_id(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "အသုံးပြုသူ ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **အသုံးပြုသူ ID** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["user_id"] = message_text
+        await set_state(sender_id, STATE_COLLECTING_PAYMENT_AMOUNT, user_data)
+        await send_viber_message(sender_id, f"အသုံးပြုသူ ID ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု **ငွေပမာဏ** (ဥပမာ: 50000) ကို ထည့်သွင်းပေးပါ:")
+
+# Longest amount (in digits) accepted, so int() never has to parse an arbitrarily long string
+MAX_AMOUNT_DIGITS = 15
+
+# Plain digits, or digits with well-formed thousands separators ("25,000", not "1,2,3" or ",5").
+# \d matches the same decimal digits int() accepts (including Myanmar digits)
+_AMOUNT_RE = re.compile(r"\d{1,3}(?:,\d{3})+|\d+")
+
+async def _collect_payment_amount(sender_id: str, message_text: str, user_data: dict):
+    # Invalid input is rejected by the pattern, so int() never raises ValueError
+    text = message_text.strip()
+    digits = text.replace(",", "") if _AMOUNT_RE.fullmatch(text) else ""
+    amount = int(digits) if digits and len(digits) <= MAX_AMOUNT_DIGITS else 0
+    if amount <= 0:
+        await send_viber_message(sender_id, "ငွေပမာဏ မမှန်ကန်ပါ။ ကျေးဇူးပြု၍ မှန်ကန်သော **ငွေပမာဏ** (ဂဏန်းများသာ) ကို ထည့်သွင်းပေးပါ:")
+        return
+    user_data["amount"] = amount
+    await set_state(sender_id, STATE_COLLECTING_PAYMENT_METHOD, user_data)
+    await send_viber_message(sender_id, f"ငွေပမာဏကတော့ `{amount}` ဖြစ်ပါတယ်။ အခု **ငွေပေးချေမှု နည်းလမ်း** (ဥပမာ: KBZ Pay, Wave Money, Cash) ကို ထည့်သွင်းပေးပါ:")
+
+async def _collect_payment_method(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "ငွေပေးချေမှု နည်းလမ်း မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **ငွေပေးချေမှု နည်းလမ်း** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["method"] = message_text
+        await set_state(sender_id, STATE_COLLECTING_PAYMENT_REFERENCE_ID, user_data)
+        await send_viber_message(sender_id, f"ငွေပေးချေမှု နည်းလမ်းကတော့ `{message_text}` ဖြစ်ပါတယ်။ နောက်ဆုံးအနေနဲ့ **Reference ID** (ဥပမာ: REF123456) ကို ထည့်သွင်းပေးပါ:")
+
+async def _collect_payment_reference_id(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "Reference ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Reference ID** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["reference_id"] = message_text
+        await _complete_flow(sender_id, "payment", user_data, "ကျေးဇူးတင်ပါတယ်။ ငွေပေးချေမှု မှတ်တမ်းတင်နေပါပြီ...")
+
+# Chat Log Submission Flow
+async def _collect_chatlog_viber_id(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "Viber ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Viber ID** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["viber_id"] = message_text
+        await set_state(sender_id, STATE_COLLECTING_CHATLOG_MESSAGE, user_data)
+        await send_viber_message(sender_id, f"Viber ID ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု **Chat စာပိုဒ်** ကို ထည့်သွင်းပေးပါ:")
+
+async def _collect_chatlog_message(sender_id: str, message_text: str, user_data: dict):
+    if not message_text.strip():
+        await send_viber_message(sender_id, "Chat စာပိုဒ် မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Chat စာပိုဒ်** ကို ထည့်သွင်းပေးပါ:")
+    else:
+        user_data["message"] = message_text
+        user_data["timestamp"] = now_iso()
+        user_data["type"] = "user_message"
+        await _complete_flow(sender_id, "chatlog", user_data, "ကျေးဇူးတင်ပါတယ်။ Chat Log တင်သွင်းနေပါပြီ...")
+
+# Agent Conversation Flow
+async def _handle_agent_conversation(sender_id: str, message_text: str, user_data: dict):
+    if message_text == STOP_AGENT_CHAT_TEXT:
+        await clear_state(sender_id) # Reset state
+        # Notify agent dashboard that conversation has ended and send main menu keyboard
+        publish_agent_event({
+            "type": "conversation_ended",
+            "viber_id": sender_id,
+            "t_ns": _now(),
+            "reason": "User ended chat"
+        })
+        await send_main_menu(sender_id, "Customer Agent နှင့် စကားပြောဆိုခြင်းကို ရပ်နားလိုက်ပါပြီ။")
+        return
+
+    # Keep the agent chat alive for as long as messages keep flowing
+    await touch_state(sender_id)
+
+    # Forward user message to agent dashboard
+    agent_message_data = {
+        "type": "user_message",
+        "viber_id": sender_id,
+        "message": message_text,
+        "t_ns": _now()
+    }
+    publish_agent_event(agent_message_data)
+
+    # Log the conversation for monitoring; the payload shows the ISO timestamp, not the raw t_ns
+    log_request("/agent/conversation", "💬 User Message", {
+        "type": "user_message",
+        "viber_id": sender_id,
+        "message": message_text,
+        "timestamp": format_ns(agent_message_data["t_ns"])
+    })
+
+    # Send acknowledgment to user
+    await send_viber_message(sender_id, "📨 သင့်စာကို Agent ဆီပို့ပြီးပါပြီ။ ပြန်ဖြေကြားမှုအတွက် ခေတ္တစောင့်ဆိုင်းပေးပါ။")
+
+# Unrecognized commands in IDLE state
+async def _handle_unrecognized_message(sender_id: str, message_text: str, user_data: dict):
+    unrecognized_response = (
+        f"ကျွန်ုပ် '{message_text}' ကို နားမလည်ပါဘူး။ \n"
+        "ကျေးဇူးပြု၍ အောက်ပါ menu ခလုတ်များကို အသုံးပြုပါ:"
+    )
+    await send_viber_message(sender_id, unrecognized_response, MAIN_MENU_KEYBOARD)
+
+# Unexpected states
+async def _reset_unknown_state(sender_id: str, message_text: str, user_data: dict):
+    await clear_state(sender_id)
+    await send_main_menu(sender_id, "အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ပြန်လည်စတင်ပါ။")
+
+# Dispatch tables: menu commands (button ActionBody values) and conversation states to their handlers
+_INTENT_HANDLERS = {
+    "start_new_customer": _start_customer_flow,
+    "start_record_payment": _start_payment_flow,
+    "start_submit_chatlog": _start_chatlog_flow,
+    "trigger_simulate_failure": _run_simulated_failure,
+    "talk_to_agent": _start_agent_flow,
+}
 
+_STATE_HANDLERS = {
+    STATE_COLLECTING_CUSTOMER_NAME: _collect_customer_name,
+    STATE_COLLECTING_CUSTOMER_PHONE: _collect_customer_phone,
+    STATE_COLLECTING_CUSTOMER_REGION: _collect_customer_region,
+    STATE_COLLECTING_PAYMENT_USER_ID: _collect_payment_user_id,
+    STATE_COLLECTING_PAYMENT_AMOUNT: _collect_payment_amount,
+    STATE_COLLECTING_PAYMENT_METHOD: _collect_payment_method,
+    STATE_COLLECTING_PAYMENT_REFERENCE_ID: _collect_payment_reference_id,
+    STATE_COLLECTING_CHATLOG_VIBER_ID: _collect_chatlog_viber_id,
+    STATE_COLLECTING_CHATLOG_MESSAGE: _collect_chatlog_message,
+    STATE_TALKING_TO_AGENT: _handle_agent_conversation,
+    STATE_IDLE: _handle_unrecognized_message,
+}
+
+# Bound on concurrently processed webhook events, so a burst can't run unbounded work at once
+WEBHOOK_CONCURRENCY = asyncio.Semaphore(500)
+
+# Strong references to in-flight event tasks (the event loop only keeps weak ones)
+_webhook_tasks = set()
+# How long shutdown waits for in-flight event tasks
+WEBHOOK_DRAIN_SECONDS = 10.0
+
+# One lock per sender so out-of-order events for the same user don't interleave state updates.
+# Entries disappear on their own once no task holds the lock anymore.
+_sender_locks = weakref.WeakValueDictionary()
+
+def _get_sender_lock(sender_id: str) -> asyncio.Lock:
+    lock = _sender_locks.get(sender_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _sender_locks[sender_id] = lock
+    return lock
+
+# Where each Viber event type carries the user's id
+_SENDER_ID_GETTERS = {
+    'message': lambda event: event.get('sender', {}).get('id'),
+    'conversation_started': lambda event: event.get('user', {}).get('id'),
+    'delivered': lambda event: event.get('user_id'),
+    'seen': lambda event: event.get('user_id'),
+    'failed': lambda event: event.get('user_id'),
+    'subscribed': lambda event: event.get('user', {}).get('id'),
+    'unsubscribed': lambda event: event.get('user_id'),
+}
+
+# message_tokens of recently accepted conversation events, for dropping Viber's redeliveries
+_seen_message_tokens = TTLCache(maxsize=50_000, ttl=600)
+
+# UPDATED: Viber Webhook endpoint logic for comprehensive conversation flow.
+# Viber retries slow webhooks, so the endpoint only parses and acknowledges the event;
+# the conversation flow runs in a background task.
+def viber_signature_valid(body: bytes, signature: str) -> bool:
+    # Viber signs the raw body: hex HMAC-SHA256 keyed with the bot's auth token. Hashing the bytes
+    # as received avoids re-serializing the parsed event, and the comparison is constant-time.
+    expected = hmac.new(CFG.viber_signing_key, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.encode(), signature.encode())
 
-# UPDATED: Viber Webhook endpoint logic for comprehensive conversation flow
 @app.post("/viber/webhook")
-async def viber_webhook(request: Request):
+async def viber_webhook(request: Request, x_viber_content_signature: str = Header(None)):
     endpoint = "/viber/webhook"
+    body = await request.body()
+    # Only enforced with a real bot token; without one Viber can't be delivering (or signing) events
+    if VIBER_SEND_ENABLED and not viber_signature_valid(body, x_viber_content_signature or ""):
+        log_request(endpoint, "❌ Auth Failed", {}, "Invalid or missing X-Viber-Content-Signature")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Viber signature")
     try:
-        viber_event_data = await request.json()
+        viber_event_data = orjson.loads(body)
         event_type = viber_event_data.get('event')
 
-        sender_id = None
-        if event_type == 'message':
-            sender_id = viber_event_data.get('sender', {}).get('id')
-        elif event_type == 'conversation_started':
-            sender_id = viber_event_data.get('user', {}).get('id')
-        elif event_type in ['delivered', 'seen', 'failed', 'subscribed', 'unsubscribed']:
-            sender_id = viber_event_data.get('user_id')
+        get_sender_id = _SENDER_ID_GETTERS.get(event_type)
+        sender_id = get_sender_id(viber_event_data) if get_sender_id else None
 
         log_request(endpoint, f"📞 Viber {event_type.capitalize()}", viber_event_data)
 
@@ -379,262 +779,77 @@ async def viber_webhook(request: Request):
             # For events without a direct sender_id (like webhook, client_status)
             return {"status": "ok", "message": "No sender ID found for state management"}
 
-        current_user_state = user_states.get(sender_id, {"state": STATE_IDLE, "data": {}})
-        current_state = current_user_state.get("state")
-        user_data = current_user_state.get("data", {})
-
-        # Handle 'conversation_started' event (user joins or bot is activated)
-        if event_type == 'conversation_started':
-            welcome_text = "မင်္ဂလာပါ! UAT Bot မှ ကြိုဆိုပါတယ်။ ဘယ်လိုကူညီပေးရမလဲ?"
-            await send_viber_message(sender_id, welcome_text, MAIN_MENU_KEYBOARD)
-            user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-            print(f"Conversation started with {sender_id}. Welcome message sent.")
-
-        # Handle 'message' event (user sends text or clicks keyboard button)
-        elif event_type == 'message':
-            message_type = viber_event_data.get('message', {}).get('type')
-
-            if message_type == 'text':
-                message_text = viber_event_data.get('message', {}).get('text')
-
-                # --- Handle direct commands/menu button clicks ---
-                if message_text == "start_new_customer":
-                    user_states[sender_id] = {"state": STATE_COLLECTING_CUSTOMER_NAME, "data": {}}
-                    await send_viber_message(sender_id, "ဖောက်သည်အသစ် ဖန်တီးပါမယ်။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **အမည်** (ဥပမာ: ဦးအောင်ကျော်) ကို ထည့်သွင်းပေးပါ:")
-
-                elif message_text == "start_record_payment":
-                    user_states[sender_id] = {"state": STATE_COLLECTING_PAYMENT_USER_ID, "data": {}}
-                    await send_viber_message(sender_id, "ငွေပေးချေမှု မှတ်တမ်းတင်ပါမယ်။ ကျေးဇူးပြု၍ **အသုံးပြုသူ ID** (ဥပမာ: UAT001) ကို ထည့်သွင်းပေးပါ:")
-
-                elif message_text == "start_submit_chatlog":
-                    user_states[sender_id] = {"state": STATE_COLLECTING_CHATLOG_VIBER_ID, "data": {}}
-                    await send_viber_message(sender_id, "Chat Log တင်သွင်းပါမယ်။ ကျေးဇူးပြု၍ **Viber ID** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
-
-                elif message_text == "trigger_simulate_failure":
-                    await send_viber_message(sender_id, "ချို့ယွင်းချက်အတုကို စတင်ဖန်တီးနေပါပြီ...")
-                    result = await _trigger_simulate_failure()
-                    if result and result.get("status") == "success":
-                        await send_viber_message(sender_id, "✅ ချို့ယွင်းချက်အတုကို အောင်မြင်စွာ ဖန်တီးပြီးပါပြီ။")
-                    else:
-                        await send_viber_message(sender_id, f"💥 ချို့ယွင်းချက်အတု endpoint မှ အမှားအယွင်း ပြန်လည်ဖြေကြားပါသည်။: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}")
-                    user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-                    await send_main_menu(sender_id)
-
-                elif message_text == "talk_to_agent":
-                    user_states[sender_id] = {"state": STATE_TALKING_TO_AGENT, "data": {}}  # Fixed: added data
-                    # Notify the agent dashboard about this new conversation
-                    await agent_broadcast_queue.put({
-                        "type": "new_conversation",
-                        "viber_id": sender_id,
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                    agent_message = (
-                        "ယခု Customer Agent နှင့် တိုက်ရိုက်စကားပြောဆိုနိုင်ပါပြီ။\n"
-                        "Agent မှ ပြန်ဖြေကြားသည်အထိ ခေတ္တစောင့်ဆိုင်းပေးပါ။\n"
-                        "စကားပြောဆိုမှုကို ရပ်နားလိုပါက 'ရပ်မည်' ဟု ရိုက်ထည့်ပေးပါ။"
-                    )
-                    await send_viber_message(sender_id, agent_message)
-
-                elif message_text == "ရပ်မည်" and current_state == STATE_TALKING_TO_AGENT:
-                    user_states[sender_id] = {"state": STATE_IDLE, "data": {}} # Reset state
-                    await send_viber_message(sender_id, "Customer Agent နှင့် စကားပြောဆိုခြင်းကို ရပ်နားလိုက်ပါပြီ။")
-                    await send_main_menu(sender_id) # Send main menu keyboard
-                    # Notify agent dashboard that conversation has ended
-                    await agent_broadcast_queue.put({
-                        "type": "conversation_ended",
-                        "viber_id": sender_id,
-                        "timestamp": datetime.utcnow().isoformat(),
-                        "reason": "User ended chat"
-                    })
-
-                # --- Handle ongoing conversation states ---
-                # Customer Creation Flow
-                elif current_state == STATE_COLLECTING_CUSTOMER_NAME:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "အမည်မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **အမည်** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["name"] = message_text
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_CUSTOMER_PHONE
-                        await send_viber_message(sender_id, f"အမည်ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု ဖောက်သည်၏ **ဖုန်းနံပါတ်** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_CUSTOMER_PHONE:
-                    # Basic validation for phone number (can be improved with regex)
-                    if not message_text.strip() or not (message_text.startswith('+') and message_text[1:].isdigit()):
-                        await send_viber_message(sender_id, "ဖုန်းနံပါတ် မမှန်ကန်ပါ။ ကျေးဇူးပြု၍ မှန်ကန်သော **ဖုန်းနံပါတ်** (ဥပမာ: +95912345678) ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["phone"] = message_text
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_CUSTOMER_REGION
-                        await send_viber_message(sender_id, f"ဖုန်းနံပါတ်ကတော့ `{message_text}` ဖြစ်ပါတယ်။ နောက်ဆုံးအနေနဲ့ ဖောက်သည်၏ **တိုင်းဒေသကြီး/ပြည်နယ်** (ဥပမာ: ရန်ကုန်၊ မန္တလေး) ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_CUSTOMER_REGION:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "တိုင်းဒေသကြီး/ပြည်နယ် မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ ဖောက်သည်၏ **တိုင်းဒေသကြီး/ပြည်နယ်** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["region"] = message_text
-                        user_states[sender_id]["data"] = user_data
-
-                        await send_viber_message(sender_id, "ကျေးဇူးတင်ပါတယ်။ ဖောက်သည်အချက်အလက်များကို ဆောင်ရွက်နေပါပြီ...")
-                        try:
-                            customer_data_model = CustomerCreate(**user_data)
-                            result = await _process_customer_creation(customer_data_model)
-                            if result and result.get("status") == "success":
-                                await send_viber_message(sender_id, "✅ ဖောက်သည်ကို အောင်မြင်စွာ ဖန်တီးပြီးပါပြီ။ နောက်ထပ် ဝန်ဆောင်မှုများကို လုပ်ဆောင်နိုင်ပါပြီ။")
-                            else:
-                                await send_viber_message(sender_id, f"❌ ဖောက်သည်ဖန်တီးခြင်း မအောင်မြင်ပါ။: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}")
-                        except ValidationError as ex:
-                            await send_viber_message(sender_id, f"ဖောက်သည်အချက်အလက် ထည့်သွင်းမှု မှားယွင်းပါသည်။: {ex.errors()[0]['msg']}. ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-                        except Exception as ex:
-                            print(f"Error calling _process_customer_creation: {ex}")
-                            await send_viber_message(sender_id, "💥 ဖောက်သည်ဖန်တီးနေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-
-                        user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-                        await send_main_menu(sender_id)
-
-                # Payment Recording Flow
-                elif current_state == STATE_COLLECTING_PAYMENT_USER_ID:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "အသုံးပြုသူ ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **အသုံးပြုသူ ID** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["user_id"] = message_text
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_PAYMENT_AMOUNT
-                        await send_viber_message(sender_id, f"အသုံးပြုသူ ID ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု **ငွေပမာဏ** (ဥပမာ: 50000) ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_PAYMENT_AMOUNT:
-                    try:
-                        amount = int(message_text.strip())
-                        if amount <= 0:
-                            raise ValueError("Amount must be positive")
-                        user_data["amount"] = amount
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_PAYMENT_METHOD
-                        await send_viber_message(sender_id, f"ငွေပမာဏကတော့ `{amount}` ဖြစ်ပါတယ်။ အခု **ငွေပေးချေမှု နည်းလမ်း** (ဥပမာ: KBZ Pay, Wave Money, Cash) ကို ထည့်သွင်းပေးပါ:")
-                    except ValueError:
-                        await send_viber_message(sender_id, "ငွေပမာဏ မမှန်ကန်ပါ။ ကျေးဇူးပြု၍ မှန်ကန်သော **ငွေပမာဏ** (ဂဏန်းများသာ) ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_PAYMENT_METHOD:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "ငွေပေးချေမှု နည်းလမ်း မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **ငွေပေးချေမှု နည်းလမ်း** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["method"] = message_text
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_PAYMENT_REFERENCE_ID
-                        await send_viber_message(sender_id, f"ငွေပေးချေမှု နည်းလမ်းကတော့ `{message_text}` ဖြစ်ပါတယ်။ နောက်ဆုံးအနေနဲ့ **Reference ID** (ဥပမာ: REF123456) ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_PAYMENT_REFERENCE_ID:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "Reference ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Reference ID** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["reference_id"] = message_text
-                        user_states[sender_id]["data"] = user_data
-
-                        await send_viber_message(sender_id, "ကျေးဇူးတင်ပါတယ်။ ငွေပေးချေမှု မှတ်တမ်းတင်နေပါပြီ...")
-                        try:
-                            payment_data_model = Payment(**user_data)
-                            result = await _process_payment_record(payment_data_model)
-                            if result and result.get("status") == "success":
-                                await send_viber_message(sender_id, "✅ ငွေပေးချေမှု မှတ်တမ်းကို အောင်မြင်စွာ တင်ပြီးပါပြီ။")
-                            else:
-                                await send_viber_message(sender_id, f"❌ ငွေပေးချေမှု မှတ်တမ်းတင်ခြင်း မအောင်မြင်ပါ။: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}")
-                        except ValidationError as ex:
-                            await send_viber_message(sender_id, f"ငွေပေးချေမှု အချက်အလက် ထည့်သွင်းမှု မှားယွင်းပါသည်။: {ex.errors()[0]['msg']}. ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-                        except Exception as ex:
-                            print(f"Error calling _process_payment_record: {ex}")
-                            await send_viber_message(sender_id, "💥 ငွေပေးချေမှု မှတ်တမ်းတင်နေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-
-                        user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-                        await send_main_menu(sender_id)
-
-                # Chat Log Submission Flow
-                elif current_state == STATE_COLLECTING_CHATLOG_VIBER_ID:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "Viber ID မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Viber ID** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["viber_id"] = message_text
-                        user_states[sender_id]["data"] = user_data
-                        user_states[sender_id]["state"] = STATE_COLLECTING_CHATLOG_MESSAGE
-                        await send_viber_message(sender_id, f"Viber ID ကတော့ `{message_text}` ဖြစ်ပါတယ်။ အခု **Chat စာပိုဒ်** ကို ထည့်သွင်းပေးပါ:")
-
-                elif current_state == STATE_COLLECTING_CHATLOG_MESSAGE:
-                    if not message_text.strip():
-                        await send_viber_message(sender_id, "Chat စာပိုဒ် မထည့်ရသေးပါ။ ကျေးဇူးပြု၍ **Chat စာပိုဒ်** ကို ထည့်သွင်းပေးပါ:")
-                    else:
-                        user_data["message"] = message_text
-                        user_data["timestamp"] = datetime.utcnow().isoformat()
-                        user_data["type"] = "user_message"
-                        user_states[sender_id]["data"] = user_data
-
-                        await send_viber_message(sender_id, "ကျေးဇူးတင်ပါတယ်။ Chat Log တင်သွင်းနေပါပြီ...")
-                        try:
-                            chatlog_data_model = ChatLog(**user_data)
-                            result = await _process_chat_log_submission(chatlog_data_model)
-                            if result and result.get("status") == "success":
-                                await send_viber_message(sender_id, "✅ Chat Log ကို အောင်မြင်စွာ တင်သွင်းပြီးပါပြီ။")
-                            else:
-                                await send_viber_message(sender_id, f"❌ Chat Log တင်သွင်းခြင်း မအောင်မြင်ပါ။: {result.get('message', 'အမှားအယွင်း တစ်ခုခု ဖြစ်ပွားခဲ့ပါသည်။')}")
-                        except ValidationError as ex:
-                            await send_viber_message(sender_id, f"Chat Log အချက်အလက် ထည့်သွင်းမှု မှားယွင်းပါသည်။: {ex.errors()[0]['msg']}. ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-                        except Exception as ex:
-                            print(f"Error calling _process_chat_log_submission: {ex}")
-                            await send_viber_message(sender_id, "💥 Chat Log တင်သွင်းနေစဉ် အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ထပ်မံကြိုးစားပါ။")
-
-                        user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-                        await send_main_menu(sender_id)
-
-                # Agent Conversation Flow
-                elif current_state == STATE_TALKING_TO_AGENT:
-                    # Forward user message to agent dashboard
-                    agent_message_data = {
-                        "type": "user_message",
-                        "viber_id": sender_id,
-                        "message": message_text,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                    await agent_broadcast_queue.put(agent_message_data)
-                    
-                    # Log the conversation for monitoring
-                    log_request("/agent/conversation", "💬 User Message", agent_message_data)
-                    
-                    # Send acknowledgment to user
-                    await send_viber_message(sender_id, "📨 သင့်စာကို Agent ဆီပို့ပြီးပါပြီ။ ပြန်ဖြေကြားမှုအတွက် ခေတ္တစောင့်ဆိုင်းပေးပါ။")
-
-                # Handle unrecognized commands in IDLE state
-                elif current_state == STATE_IDLE:
-                    unrecognized_response = (
-                        f"ကျွန်ုပ် '{message_text}' ကို နားမလည်ပါဘူး။ \n"
-                        "ကျေးဇူးပြု၍ အောက်ပါ menu ခလုတ်များကို အသုံးပြုပါ:"
-                    )
-                    await send_viber_message(sender_id, unrecognized_response, MAIN_MENU_KEYBOARD)
-
-                # Handle unexpected states
-                else:
-                    await send_viber_message(sender_id, "အမှားအယွင်း ဖြစ်ပွားခဲ့ပါသည်။ ကျေးဇူးပြု၍ ပြန်လည်စတင်ပါ။")
-                    user_states[sender_id] = {"state": STATE_IDLE, "data": {}}
-                    await send_main_menu(sender_id)
-
-            # Handle non-text messages
-            else:
-                await send_viber_message(sender_id, "ကျွန်ုပ်တို့ text message များကိုသာ လက်ခံပါသည်။ ကျေးဇူးပြု၍ text ဖြင့်ပေးပို့ပါ။")
+        if event_type not in _EVENT_HANDLERS:
+            # Delivery/seen/subscription receipts only need logging; don't spend a task and lock on them
+            return {"status": "ok", "message": "Event acknowledged"}
 
-        # Handle other event types (delivered, seen, failed, etc.)
-        else:
-            print(f"Received Viber event '{event_type}' from {sender_id}")
+        # Viber retries slow or failed deliveries with the same message_token; run each event once
+        message_token = viber_event_data.get('message_token')
+        if message_token is not None:
+            if message_token in _seen_message_tokens:
+                return {"status": "ok", "message": "Duplicate event ignored"}
+            _seen_message_tokens[message_token] = True
 
-        return {"status": "ok", "message": "Event processed successfully"}
+        task = asyncio.create_task(_handle_viber_event(sender_id, event_type, viber_event_data))
+        _webhook_tasks.add(task)
+        task.add_done_callback(_webhook_tasks.discard)
+        return {"status": "ok", "message": "Event accepted for processing"}
 
     except Exception as e:
         error_message = f"Viber webhook error: {str(e)}"
-        print(error_message)
+        logger.error("Viber webhook error: %s", e)
         log_request(endpoint, "💥 Webhook Error", {"error": error_message})
         return {"status": "error", "message": error_message}
 
+# Handle 'conversation_started' event (user joins or bot is activated)
+async def _on_conversation_started(sender_id: str, viber_event_data: dict):
+    welcome_text = "မင်္ဂလာပါ! UAT Bot မှ ကြိုဆိုပါတယ်။ ဘယ်လိုကူညီပေးရမလဲ?"
+    await send_viber_message(sender_id, welcome_text, MAIN_MENU_KEYBOARD)
+    await clear_state(sender_id)
+    logger.debug("Conversation started with %s. Welcome message sent.", sender_id)
+
+# Handle 'message' event (user sends text or clicks keyboard button)
+async def _on_message(sender_id: str, viber_event_data: dict):
+    message = viber_event_data.get('message', {})
+    if message.get('type') != 'text':
+        # Handle non-text messages
+        await send_viber_message(sender_id, "ကျွန်ုပ်တို့ text message များကိုသာ လက်ခံပါသည်။ ကျေးဇူးပြု၍ text ဖြင့်ပေးပို့ပါ။")
+        return
+    message_text = message.get('text')
+
+    # Menu button clicks take priority over any ongoing flow and start afresh, so they don't need the stored state
+    handler = _INTENT_HANDLERS.get(message_text)
+    if handler is not None:
+        await handler(sender_id, message_text, {})
+        return
+
+    # Otherwise the current state decides
+    current_user_state = await get_state(sender_id, {"state": STATE_IDLE, "data": {}})
+    handler = _STATE_HANDLERS.get(current_user_state.get("state"), _reset_unknown_state)
+    await handler(sender_id, message_text, current_user_state.get("data", {}))
+
+# Event types that drive the conversation flow, handled in the background
+_EVENT_HANDLERS = {
+    'conversation_started': _on_conversation_started,
+    'message': _on_message,
+}
+
+async def _handle_viber_event(sender_id: str, event_type: str, viber_event_data: dict):
+    sender_lock = _get_sender_lock(sender_id)
+    async with sender_lock, WEBHOOK_CONCURRENCY:
+        try:
+            await _EVENT_HANDLERS[event_type](sender_id, viber_event_data)
+        except Exception as e:
+            error_message = f"Viber webhook error: {str(e)}"
+            logger.exception("Viber webhook error: %s", e)
+            log_request("/viber/webhook", "💥 Webhook Error", {"error": error_message})
+
 
 # Agent Dashboard endpoints
 def verify_monitor_credentials(credentials: HTTPBasicCredentials = Depends(security)):
-    is_correct_username = secrets.compare_digest(credentials.username, MONITOR_USERNAME)
-    is_correct_password = secrets.compare_digest(credentials.password, MONITOR_PASSWORD)
+    # Compared as bytes: compare_digest raises TypeError on non-ASCII str input
+    is_correct_username = secrets.compare_digest(credentials.username.encode(), CFG.monitor_user)
+    is_correct_password = secrets.compare_digest(credentials.password.encode(), CFG.monitor_pass)
     if not (is_correct_username and is_correct_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -651,46 +866,98 @@ async def agent_dashboard(request: Request, credentials: HTTPBasicCredentials =
 async def agent_events_stream(credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
     """Server-Sent Events endpoint for agent dashboard"""
     async def event_stream():
+        subscriber = AgentSubscriber()
+        agent_subscribers.add(subscriber)
+        frames = subscriber.frames
+        wait_task = None
         try:
-            yield "data: {\"type\": \"connected\", \"message\": \"Agent dashboard connected\"}\n\n"
+            yield AGENT_CONNECTED_FRAME
             
             while True:
-                try:
-                    # Wait for new events with timeout
-                    event = await asyncio.wait_for(agent_broadcast_queue.get(), timeout=30.0)
-                    yield f"data: {json.dumps(event)}\n\n"
-                except asyncio.TimeoutError:
+                if frames:
+                    # Coalesce frames that queued up meanwhile into one write; each stays its own SSE event
+                    if len(frames) == 1:
+                        yield frames.popleft()
+                    else:
+                        yield b"".join([frames.popleft() for _ in range(min(len(frames), SSE_BATCH_MAX))])
+                    continue
+                # Buffer is empty: wait for the next publish. The pending wait survives heartbeats, and
+                # asyncio.wait returns on timeout instead of raising, so idle connections cost no exception
+                subscriber.ready.clear()
+                if wait_task is None:
+                    wait_task = asyncio.ensure_future(subscriber.ready.wait())
+                done, _ = await asyncio.wait({wait_task}, timeout=SSE_KEEPALIVE_SECONDS)
+                if done:
+                    wait_task = None
+                else:
                     # Send heartbeat to keep connection alive
-                    yield "data: {\"type\": \"heartbeat\"}\n\n"
-                except Exception as e:
-                    print(f"Error in event stream: {e}")
-                    break
+                    yield SSE_HEARTBEAT_FRAME
         except Exception as e:
-            print(f"Event stream error: {e}")
-            yield f"data: {{\"type\": \"error\", \"message\": \"Stream error: {str(e)}\"}}\n\n"
+            logger.error("Event stream error: %s", e)
+            yield sse_frame({"type": "error", "message": f"Stream error: {str(e)}"})
+        finally:
+            if wait_task is not None:
+                wait_task.cancel()
+            agent_subscribers.discard(subscriber)
     
-    return StreamingResponse(event_stream(), media_type="text/plain")
-
-@app.post("/agent/send_message")
-async def agent_send_message(data: AgentSendMessage, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# Agent bodies are validated straight from the raw bytes by pydantic-core, which parses the JSON
+# itself, instead of FastAPI's json.loads followed by model validation
+_AGENT_SEND_MESSAGE = TypeAdapter(AgentSendMessage)
+_AGENT_END_CHAT = TypeAdapter(AgentEndChat)
+
+async def _parse_body(request: Request, adapter: TypeAdapter):
+    # Errors are reshaped to match the 422 FastAPI gives for a declared body model: locations
+    # start with "body", and undecodable JSON is reported at ("body", <offset>)
+    body = await request.body()
+    if not body:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+    try:
+        return adapter.validate_json(body)
+    except ValidationError as e:
+        errors = e.errors(include_url=False)
+    if errors[0]["type"] == "json_invalid":
+        # Only on the error path: decode again to get the offset pydantic doesn't expose
+        try:
+            orjson.loads(body)
+        except orjson.JSONDecodeError as decode_error:
+            raise RequestValidationError([{
+                "type": "json_invalid",
+                "loc": ("body", decode_error.pos),
+                "msg": "JSON decode error",
+                "input": {},
+                "ctx": {"error": decode_error.msg}
+            }])
+    raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in errors])
+
+def _json_body_schema(model: type[BaseModel]) -> dict:
+    # Keeps the OpenAPI docs showing the request body the handler parses by hand
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+@app.post("/agent/send_message", openapi_extra=_json_body_schema(AgentSendMessage))
+async def agent_send_message(request: Request, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
     """Endpoint for agents to send messages to users"""
+    data = await _parse_body(request, _AGENT_SEND_MESSAGE)
     try:
-        # Send message to user via Viber
-        await send_viber_message(data.receiver_viber_id, data.message_text)
+        # Send message to user via Viber, refreshing the chat's TTL alongside
+        await asyncio.gather(
+            send_viber_message(data.receiver_viber_id, data.message_text),
+            touch_state(data.receiver_viber_id)
+        )
         
         # Log the agent message
         log_request("/agent/send_message", "📤 Agent Message", {
             "receiver_viber_id": data.receiver_viber_id,
-            "message_text": data.message_text,
-            "timestamp": datetime.utcnow().isoformat()
+            "message_text": data.message_text
         })
         
         # Broadcast to other agents (optional, for monitoring)
-        await agent_broadcast_queue.put({
+        publish_agent_event({
             "type": "agent_message",
             "viber_id": data.receiver_viber_id,
             "message": data.message_text,
-            "timestamp": datetime.utcnow().isoformat()
+            "t_ns": _now()
         })
         
         return {"status": "success", "message": "Message sent successfully"}
@@ -703,31 +970,34 @@ async def agent_send_message(data: AgentSendMessage, credentials: HTTPBasicCrede
         })
         raise HTTPException(status_code=500, detail=error_message)
 
-@app.post("/agent/end_chat")
-async def agent_end_chat(data: AgentEndChat, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
+@app.post("/agent/end_chat", openapi_extra=_json_body_schema(AgentEndChat))
+async def agent_end_chat(request: Request, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
     """Endpoint for agents to end chat sessions"""
+    data = await _parse_body(request, _AGENT_END_CHAT)
+    # One lookup; only a live agent chat can be ended, so a user mid-way through another flow keeps it
+    user_state = await get_state(data.viber_id)
+    if user_state is None or user_state.get("state") != STATE_TALKING_TO_AGENT:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User is not in an agent chat")
     try:
         # Reset user state
-        if data.viber_id in user_states:
-            user_states[data.viber_id] = {"state": STATE_IDLE, "data": {}}
+        await clear_state(data.viber_id)
+        
+        # Broadcast to agent dashboard first; it's a non-blocking enqueue, so dashboards
+        # see the chat end without waiting on the Viber round trip below
+        publish_agent_event({
+            "type": "conversation_ended",
+            "viber_id": data.viber_id,
+            "t_ns": _now(),
+            "reason": "Agent ended chat"
+        })
         
         # Notify user that chat has ended
-        await send_viber_message(data.viber_id, "Customer Agent နှင့် စကားပြောဆိုခြင်းကို ရပ်နားလိုက်ပါပြီ။")
-        await send_main_menu(data.viber_id)
+        await send_main_menu(data.viber_id, "Customer Agent နှင့် စကားပြောဆိုခြင်းကို ရပ်နားလိုက်ပါပြီ။")
         
         # Log the action
         log_request("/agent/end_chat", "🔚 Chat Ended", {
             "viber_id": data.viber_id,
-            "ended_by": "agent",
-            "timestamp": datetime.utcnow().isoformat()
-        })
-        
-        # Broadcast to agent dashboard
-        await agent_broadcast_queue.put({
-            "type": "conversation_ended",
-            "viber_id": data.viber_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "reason": "Agent ended chat"
+            "ended_by": "agent"
         })
         
         return {"status": "success", "message": "Chat ended successfully"}
@@ -740,48 +1010,120 @@ async def agent_end_chat(data: AgentEndChat, credentials: HTTPBasicCredentials =
         })
         raise HTTPException(status_code=500, detail=error_message)
 
+@app.get("/metrics")
+async def get_metrics(credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
+    return {
+        "agent_subscribers": len(agent_subscribers),
+        "agent_broadcast_queue_size": sum(len(subscriber.frames) for subscriber in agent_subscribers),
+        "agent_broadcast_drops": _broadcast_drops
+    }
+
 # Monitor Dashboard (existing functionality)
+# Rendered monitor page and the newest log id it contains; ids only grow, so a new entry invalidates it
+_monitor_page_cache = [-1, ""]
+
 @app.get("/monitor", response_class=HTMLResponse)
 async def monitor_dashboard(request: Request, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
-    return templates.TemplateResponse("monitor.html", {"request": request})
+    # Reloads with no new log entries reuse the last rendered page. Otherwise snapshot the (capped)
+    # log store on the loop, then render off it so the page doesn't stall webhooks and SSE streams
+    # while Jinja escapes every row; later entries arrive over /monitor/events
+    last_id = last_log_id()
+    if _monitor_page_cache[0] != last_id:
+        logs = get_logs()
+        html = await asyncio.to_thread(
+            templates.get_template("monitor.html").render,
+            request=request, logs=logs, stream_after=monitor_stream_id(last_id)
+        )
+        _monitor_page_cache[0] = last_id
+        _monitor_page_cache[1] = html
+    return HTMLResponse(_monitor_page_cache[1])
 
 @app.get("/monitor/logs")
-async def get_logs(credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
-    return {"logs": log_store}
+async def monitor_logs(after: int = 0, credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
+    # ?after=<id> returns only newer entries (latest first), so polling clients skip what they have.
+    # An id ahead of the newest entry was issued before a restart, so the client gets everything.
+    if after and after <= last_log_id():
+        return {"logs": [format_log(entry) for entry in reversed(logs_after(after))]}
+    return {"logs": get_logs()}
+
+# Log ids restart at 1 in every process, so stream ids are "<boot id>-<log id>": an id handed out
+# before a restart or deploy is recognised as stale instead of holding the stream back until
+# this process has logged that many entries
+_MONITOR_BOOT_ID = secrets.token_hex(4)
+
+def monitor_stream_id(log_id: int) -> str:
+    return f"{_MONITOR_BOOT_ID}-{log_id}"
+
+def parse_monitor_stream_id(stream_id: str) -> int:
+    boot_id, _, log_id = stream_id.partition("-")
+    if boot_id == _MONITOR_BOOT_ID and log_id.isdigit() and int(log_id) <= last_log_id():
+        return int(log_id)
+    # Issued by another process: everything stored here is new to the client
+    return 0
+
+def monitor_frame(entry: LogEntry) -> bytes:
+    # The id line lets a reconnecting EventSource resume after the last entry it received
+    return b"id: " + monitor_stream_id(entry.id).encode() + b"\n" + sse_frame(format_log(entry))
 
 @app.get("/monitor/events")
-async def monitor_events_stream(credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)):
+async def monitor_events_stream(
+    after: str = None,
+    last_event_id: str = Header(None),
+    credentials: HTTPBasicCredentials = Depends(verify_monitor_credentials)
+):
     """Server-Sent Events endpoint for monitor dashboard"""
-    async def event_stream():
+    # A reconnect resumes from Last-Event-ID; the page passes the newest entry it rendered as ?after=
+    if last_event_id:
+        after = parse_monitor_stream_id(last_event_id)
+    elif after:
+        after = parse_monitor_stream_id(after)
+    else:
+        after = last_log_id()
+
+    async def event_stream(last_id: int):
+        wait_task = None
         try:
-            yield "data: {\"type\": \"connected\", \"message\": \"Monitor connected\"}\n\n"
+            yield MONITOR_CONNECTED_FRAME
             
-            last_log_count = len(log_store)
             while True:
-                await asyncio.sleep(1)  # Check every second
-                current_log_count = len(log_store)
-                
-                if current_log_count > last_log_count:
-                    # Send new logs
-                    new_logs = log_store[last_log_count:]
-                    for log in new_logs:
-                        yield f"data: {json.dumps(log)}\n\n"
-                    last_log_count = current_log_count
+                appended = log_appended()
+                new_logs = logs_after(last_id)
+                if new_logs:
+                    # Send new logs, oldest first, in a single write
+                    last_id = new_logs[-1].id
+                    yield b"".join(monitor_frame(log) for log in new_logs)
+                    continue
+                # Nothing new: sleep until the log flusher stores the next batch
+                if wait_task is None:
+                    wait_task = asyncio.ensure_future(appended.wait())
+                done, _ = await asyncio.wait({wait_task}, timeout=SSE_KEEPALIVE_SECONDS)
+                if done:
+                    wait_task = None
+                else:
+                    yield SSE_HEARTBEAT_FRAME
                 
         except Exception as e:
-            print(f"Monitor event stream error: {e}")
-            yield f"data: {{\"type\": \"error\", \"message\": \"Stream error: {str(e)}\"}}\n\n"
+            logger.error("Monitor event stream error: %s", e)
+            yield sse_frame({"type": "error", "message": f"Stream error: {str(e)}"})
+        finally:
+            if wait_task is not None:
+                wait_task.cancel()
     
-    return StreamingResponse(event_stream(), media_type="text/plain")
+    return StreamingResponse(event_stream(after), media_type="text/event-stream", headers=SSE_HEADERS)
 
 # Development server runner
 if __name__ == "__main__":
     # Use environment variables for configuration
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
+    # Auto-reload only for local development; its file watcher has no place in production
+    reload = os.getenv("DEBUG") == "1"
     
     print(f"Starting Viber UAT Middleware on {host}:{port}")
     print(f"Monitor Dashboard: http://{host}:{port}/monitor")
     print(f"Agent Dashboard: http://{host}:{port}/agent_dashboard")
     
-    uvicorn.run(app, host=host, port=port)
+    # "auto" picks uvloop and httptools when installed (uvloop is skipped on Windows) and falls back
+    # to asyncio/h11 otherwise; a single worker, since conversation state, logs and agent
+    # subscribers live in this process. Reload needs the app as an import string.
+    uvicorn.run("main:app" if reload else app, host=host, port=port, loop="auto", http="auto", reload=reload)
@@ -0,0 +1,73 @@
+import asyncio
+import orjson
+from cachetools import TTLCache
+
+from config import Config
+
+# Idle conversations expire after 30 minutes
+STATE_TTL_SECONDS = 1800
+
+# Conversation state per Viber user: {viber_user_id: {"state": "CURRENT_STATE", "data": {...}}}
+# Bounded LRU + TTL so idle conversations expire instead of piling up forever.
+user_states = TTLCache(maxsize=100_000, ttl=STATE_TTL_SECONDS)
+
+# With REDIS_URL set, state lives in Redis instead (one GET/SET per access, same TTL),
+# so it survives restarts and deploys
+_redis = None
+_STATE_KEY_PREFIX = "vus:"
+
+if Config.REDIS_URL:
+    import redis.asyncio as redis
+    _redis = redis.from_url(Config.REDIS_URL)
+
+async def get_state(sender_id: str, default: dict = None):
+    if _redis is None:
+        return user_states.get(sender_id, default)
+    raw = await _redis.get(_STATE_KEY_PREFIX + sender_id)
+    return orjson.loads(raw) if raw is not None else default
+
+async def set_state(sender_id: str, state: str, data: dict = None):
+    if data is None:
+        data = {}
+    if _redis is None:
+        entry = user_states.get(sender_id)
+        if entry is None:
+            entry = {"state": state, "data": data}
+        else:
+            # Step transitions update the stored entry in place instead of allocating a new one;
+            # it is still re-stored below so the TTL restarts
+            entry["state"] = state
+            entry["data"] = data
+        user_states[sender_id] = entry
+        return
+    entry = {"state": state, "data": data}
+    await _redis.set(_STATE_KEY_PREFIX + sender_id, orjson.dumps(entry), ex=STATE_TTL_SECONDS)
+
+async def clear_state(sender_id: str):
+    # Back to IDLE: callers treat a missing entry as IDLE, so nothing needs to be stored
+    if _redis is None:
+        user_states.pop(sender_id, None)
+        return
+    await _redis.delete(_STATE_KEY_PREFIX + sender_id)
+
+async def touch_state(sender_id: str):
+    # Reads don't reset the TTL, so re-store the entry to keep a live conversation from expiring
+    if _redis is None:
+        state = user_states.get(sender_id)
+        if state is not None:
+            user_states[sender_id] = state
+        return
+    await _redis.expire(_STATE_KEY_PREFIX + sender_id, STATE_TTL_SECONDS)
+
+# TTLCache only drops expired entries when it is written to; sweep periodically so abandoned
+# conversations are released even while the bot is quiet (Redis expires keys itself)
+STATE_SWEEP_SECONDS = 60
+
+async def state_sweeper():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_SECONDS)
+        user_states.expire()
+
+async def close_state_storage():
+    if _redis is not None:
+        await _redis.aclose()